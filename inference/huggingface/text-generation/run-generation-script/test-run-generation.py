@@ -21,26 +21,16 @@
 
 
 import argparse
+import concurrent.futures
+import copy
+import functools
 import logging
 import time
+from typing import Optional
 import numpy as np
 import torch
-from transformers.models.gpt2.modeling_gpt2 import GPT2Block as gpt2_transformer
-from transformers import (
-    CTRLLMHeadModel,
-    CTRLTokenizer,
-    GPT2LMHeadModel,
-    GPT2Tokenizer,
-    GPTNeoModel,
-    OpenAIGPTLMHeadModel,
-    OpenAIGPTTokenizer,
-    TransfoXLLMHeadModel,
-    TransfoXLTokenizer,
-    XLMTokenizer,
-    XLMWithLMHeadModel,
-    XLNetLMHeadModel,
-    XLNetTokenizer,
-)
+import transformers
+from packaging import version
 
 
 logging.basicConfig(
@@ -51,15 +41,26 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 MAX_LENGTH = int(10000)  # Hardcoded max length to avoid infinite loop
+FP8_E4M3_MAX = 448.0  # Largest finite value representable in float8_e4m3fn
+PP_WEIGHT_MEMORY_FRACTION = 0.8  # Share of each GPU used for weights with --pp_size, the rest holds activations/KV cache
+
+# Model types whose transformer body is plain Linear/Conv1D layers that FP8Linear can replace
+FP8_MODEL_TYPES = {"gpt2", "gptneo"}
+
+# Model types whose HF implementation can be loaded with the FlashAttention-2 kernel
+FLASH_ATTN_MODEL_TYPES = {"gpt2", "gptneo"}
 
+# Rust-backed fast tokenizers where transformers provides one, so the whole prompt file is encoded in one call.
+# Classes are named rather than imported: transformers loads a model's module on first attribute access,
+# so only the selected model type is ever imported.
 MODEL_CLASSES = {
-    "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
-    "gptneo": (GPTNeoModel, GPT2Tokenizer),
-    "ctrl": (CTRLLMHeadModel, CTRLTokenizer),
-    "openai-gpt": (OpenAIGPTLMHeadModel, OpenAIGPTTokenizer),
-    "xlnet": (XLNetLMHeadModel, XLNetTokenizer),
-    "transfo-xl": (TransfoXLLMHeadModel, TransfoXLTokenizer),
-    "xlm": (XLMWithLMHeadModel, XLMTokenizer),
+    "gpt2": ("GPT2LMHeadModel", "GPT2TokenizerFast"),
+    "gptneo": ("GPTNeoModel", "GPT2TokenizerFast"),
+    "ctrl": ("CTRLLMHeadModel", "CTRLTokenizer"),
+    "openai-gpt": ("OpenAIGPTLMHeadModel", "OpenAIGPTTokenizerFast"),
+    "xlnet": ("XLNetLMHeadModel", "XLNetTokenizerFast"),
+    "transfo-xl": ("TransfoXLLMHeadModel", "TransfoXLTokenizer"),
+    "xlm": ("XLMWithLMHeadModel", "XLMTokenizer"),
 }
 
 # Padding text to help Transformer-XL and XLNet with short prompts as proposed by Aman Rusia
@@ -143,26 +144,191 @@ def adjust_length_to_model(length, max_sequence_length):
         length = MAX_LENGTH  # avoid infinite loop
     return length
 
-def print_latency(latency_set, title=""):
-    # 10 warmup queries
-    latency_set = latency_set[10:]
-    count = len(latency_set)
-    if count > 0:
-        latency_set.sort()
-        n50 = (count - 1) * 0.5 + 1
-        n90 = (count - 1) * 0.9 + 1
-        n95 = (count - 1) * 0.95 + 1
-        n99 = (count - 1) * 0.99 + 1
-        n999 = (count - 1) * 0.999 + 1
-
-        avg = sum(latency_set) / count
-        p50 = latency_set[int(n50) - 1]
-        p90 = latency_set[int(n90) - 1]
-        p95 = latency_set[int(n95) - 1]
-        p99 = latency_set[int(n99) - 1]
-        p999 = latency_set[int(n999) - 1]
-
-        print("====== latency stats {0} ======", title)
+def transformers_older_than(min_version):
+    return version.parse(transformers.__version__) < version.parse(min_version)
+
+
+def read_prompts(path):
+    with open(path, "r", encoding="utf8") as fname:
+        return fname.readlines()
+
+
+def load_model(args, model_class):
+    kwargs = {}
+    if args.flash_attn:
+        kwargs["attn_implementation"] = "flash_attention_2"
+        kwargs["torch_dtype"] = torch.float16
+    if args.int8:
+        # bitsandbytes LLM.int8(): vector-wise int8 weights with fp16 outlier decomposition
+        kwargs["load_in_8bit"] = True
+        kwargs["device_map"] = "auto"
+        kwargs["torch_dtype"] = torch.float16
+    if args.pp_size > 1:
+        # Naive pipeline: consecutive layers are split over the first pp_size GPUs and activations hop between them
+        kwargs["device_map"] = "balanced"
+        kwargs["max_memory"] = {
+            i: int(torch.cuda.get_device_properties(i).total_memory * PP_WEIGHT_MEMORY_FRACTION)
+            for i in range(args.pp_size)
+        }
+        if args.fp16:
+            kwargs["torch_dtype"] = torch.float16
+    return model_class.from_pretrained(args.model_name_or_path, **kwargs)
+
+
+class FP8Linear(torch.nn.Module):
+    """W8A8 FP8 linear layer: e4m3 weights with per-output-channel scales, e4m3 activations with
+    per-token scales computed on the fly, bf16 in/out."""
+
+    def __init__(self, weight, bias):
+        # weight is laid out as (out_features, in_features), like nn.Linear
+        super().__init__()
+        weight = weight.detach().float().contiguous()
+        w_scale = weight.abs().amax(dim=-1, keepdim=True).clamp(min=1e-12) / FP8_E4M3_MAX
+        self.register_buffer("weight", (weight / w_scale).to(torch.float8_e4m3fn))
+        self.register_buffer("weight_scale", w_scale.t().contiguous())
+        self.register_buffer("bias", None if bias is None else bias.detach().to(torch.bfloat16))
+
+    def forward(self, x):
+        out_shape = x.shape[:-1] + (self.weight.size(0),)
+        x = x.reshape(-1, x.size(-1)).to(torch.bfloat16)
+        # torch._scaled_mm takes fp8 on both sides, so activations get a dynamic per-token scale
+        x_scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-12) / FP8_E4M3_MAX
+        x_fp8 = (x / x_scale).to(torch.float8_e4m3fn)
+        out = torch._scaled_mm(
+            x_fp8,
+            self.weight.t(),
+            scale_a=x_scale,
+            scale_b=self.weight_scale,
+            bias=self.bias,
+            out_dtype=torch.bfloat16,
+        )
+        return out.view(out_shape)
+
+
+def quantize_fp8(model):
+    from transformers.pytorch_utils import Conv1D
+
+    # The output head (often tied to the input embeddings) stays in bf16
+    output_embeddings = model.get_output_embeddings()
+    # Snapshot the module list first, it is mutated while swapping in FP8Linear
+    for module in list(model.modules()):
+        for child_name, child in module.named_children():
+            if child is output_embeddings:
+                continue
+            if isinstance(child, torch.nn.Linear):
+                setattr(module, child_name, FP8Linear(child.weight, child.bias))
+            elif isinstance(child, Conv1D):
+                # GPT-2 style Conv1D stores its weight as (in_features, out_features)
+                setattr(module, child_name, FP8Linear(child.weight.t(), child.bias))
+    return model
+
+
+@torch.jit.script
+def bias_gelu(bias, y):
+    # tanh approximation of GELU ("gelu_new"), fused with the preceding bias add
+    x = bias + y
+    return x * 0.5 * (1.0 + torch.tanh(0.79788456 * x * (1 + 0.044715 * x * x)))
+
+
+def gpt2_mlp_forward(self, hidden_states):
+    # c_fc matmul without its bias, the bias add is folded into the fused GELU kernel
+    size_out = hidden_states.size()[:-1] + (self.c_fc.nf,)
+    hidden_states = torch.mm(hidden_states.view(-1, hidden_states.size(-1)), self.c_fc.weight).view(size_out)
+    hidden_states = bias_gelu(self.c_fc.bias, hidden_states)
+    hidden_states = self.c_proj(hidden_states)
+    hidden_states = self.dropout(hidden_states)
+    return hidden_states
+
+
+@torch.jit.script
+def fused_scale_mask_softmax(attn_weights, causal_mask: Optional[torch.Tensor], attention_mask: Optional[torch.Tensor],
+                             scale: float):
+    # fp32 intermediates keep the softmax numerically stable when the model runs in fp16
+    attn_weights = attn_weights.float() * scale
+    if causal_mask is not None:
+        attn_weights = attn_weights.masked_fill(~causal_mask, -10000.0)
+    if attention_mask is not None:
+        attn_weights = attn_weights + attention_mask
+    return torch.softmax(attn_weights, dim=-1)
+
+
+def gpt2_attn(self, query, key, value, attention_mask=None, head_mask=None):
+    # Same as GPT2Attention._attn, with scale, masking and softmax in one scripted function
+    scale = 1.0
+    if self.scale_attn_weights:
+        scale /= value.size(-1) ** 0.5
+    # Layer-wise attention scaling
+    if self.scale_attn_by_inverse_layer_idx:
+        scale /= float(self.layer_idx + 1)
+
+    causal_mask = None
+    if not self.is_cross_attention:
+        query_length, key_length = query.size(-2), key.size(-2)
+        causal_mask = self.bias[:, :, key_length - query_length:key_length, :key_length].to(torch.bool)
+
+    attn_weights = torch.matmul(query, key.transpose(-1, -2))
+    attn_weights = fused_scale_mask_softmax(attn_weights, causal_mask, attention_mask, scale)
+
+    # Downcast back to V's dtype (if in mixed-precision) -- No-Op otherwise
+    attn_weights = attn_weights.type(value.dtype)
+    attn_weights = self.attn_dropout(attn_weights)
+
+    # Mask heads if we want to
+    if head_mask is not None:
+        attn_weights = attn_weights * head_mask
+
+    attn_output = torch.matmul(attn_weights, value)
+
+    return attn_output, attn_weights
+
+
+def gpt2_attn_forward(self, hidden_states, layer_past=None, attention_mask=None, head_mask=None,
+                      encoder_hidden_states=None, encoder_attention_mask=None, use_cache=False, output_attentions=False):
+    # Self-attention only: Q, K and V are split into heads and transposed with a single view + permute
+    # on the fused c_attn output, instead of split() followed by three _split_heads() calls
+    bsz, seq_len = hidden_states.size()[:2]
+    qkv = self.c_attn(hidden_states).view(bsz, seq_len, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+    query, key, value = qkv.unbind(0)
+
+    if layer_past is not None:
+        past_key, past_value = layer_past
+        key = torch.cat((past_key, key), dim=-2)
+        value = torch.cat((past_value, value), dim=-2)
+
+    present = (key, value) if use_cache else None
+
+    if self.reorder_and_upcast_attn:
+        attn_output, attn_weights = self._upcast_and_reordered_attn(query, key, value, attention_mask, head_mask)
+    else:
+        attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask)
+
+    attn_output = self._merge_heads(attn_output, self.num_heads, self.head_dim)
+    attn_output = self.c_proj(attn_output)
+    attn_output = self.resid_dropout(attn_output)
+
+    outputs = (attn_output, present)
+    if output_attentions:
+        outputs += (attn_weights,)
+
+    return outputs  # a, present, (attentions)
+
+
+@functools.lru_cache(maxsize=None)
+def get_injection_policy():
+    # Built once on first use, so deepspeed is only imported when --ds-inference is requested
+    import deepspeed.module_inject as module_inject
+    from transformers.models.gpt2.modeling_gpt2 import GPT2Block as gpt2_transformer
+    return {gpt2_transformer: module_inject.replace_policy.HFGPT2LayerPolicy}
+
+
+def print_latency(latency_set, title="", warmup=10):
+    # trim warmup queries
+    latency_set = np.asarray(latency_set[warmup:], dtype=np.float64)
+    if latency_set.size > 0:
+        avg = latency_set.mean()
+        p50, p90, p95, p99, p999 = np.percentile(latency_set, [50, 90, 95, 99, 99.9])
+
+        print("====== latency stats {0} ======".format(title))
         print("\tAvg Latency: {0:8.2f} ms".format(avg * 1000))
         print("\tP50 Latency: {0:8.2f} ms".format(p50 * 1000))
         print("\tP90 Latency: {0:8.2f} ms".format(p90 * 1000))
@@ -202,12 +368,12 @@ def main():
         "--temperature",
         type=float,
         default=1.0,
-        help="temperature of 1.0 has no effect, lower tend toward greedy sampling",
+        help="temperature of 1.0 has no effect, lower tend toward greedy sampling, 0 decodes greedily",
     )
     parser.add_argument(
         "--repetition_penalty", type=float, default=1.0, help="primarily useful for CTRL model; in that case, use 1.2"
     )
-    parser.add_argument("--k", type=int, default=0)
+    parser.add_argument("--k", type=int, default=0, help="top-k sampling, 0 disables it and 1 decodes greedily")
     parser.add_argument("--p", type=float, default=0.9)
 
     parser.add_argument("--prefix", type=str, default="", help="Text added prior to input.")
@@ -218,14 +384,96 @@ def main():
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
     parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
     parser.add_argument("--num_return_sequences", type=int, default=1, help="The number of samples to generate.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of prompts per generate call")
     parser.add_argument(
         "--fp16",
         action="store_true",
         help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
     )
     parser.add_argument('--ds-inference', action="store_true", help="Use deepspeed")
+    parser.add_argument(
+        "--flash_attn",
+        action="store_true",
+        help="Use FlashAttention-2 (requires --fp16, flash-attn and a transformers release with FlashAttention-2 "
+        "support for the model, newer than the pinned requirements)",
+    )
+    parser.add_argument(
+        "--fp8",
+        action="store_true",
+        help="Run Linear layers as W8A8 FP8 (e4m3): per-channel weight and per-token activation scales, bf16 "
+        "outside the matmuls (requires sm_90, e.g. H100, and torch>=2.5 for row-wise scaled_mm)",
+    )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Load the model with bitsandbytes LLM.int8() quantization (requires bitsandbytes and accelerate)",
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        help="Compile the model forward with torch.compile(mode='reduce-overhead') (requires torch>=2.0)",
+    )
+    parser.add_argument(
+        "--bt",
+        action="store_true",
+        help="Use BetterTransformer fused attention and a fused bias+GELU MLP instead of kernel injection "
+        "(requires optimum)",
+    )
+    parser.add_argument(
+        "--cache_prefix",
+        action="store_true",
+        help="Prefill the shared --prefix once and reuse its KV cache for every prompt (requires transformers>=4.36)",
+    )
+    parser.add_argument(
+        "--pp_size",
+        type=int,
+        default=1,
+        help="Split the model layers over this many GPUs in a single process (requires accelerate). "
+        "This only adds capacity for models that do not fit on one GPU: the stages run one after another, "
+        "so it does not improve throughput",
+    )
     args = parser.parse_args()
 
+    if args.flash_attn and not args.fp16:
+        parser.error("--flash_attn requires --fp16")
+    if args.flash_attn and args.model_type.lower() not in FLASH_ATTN_MODEL_TYPES:
+        parser.error("--flash_attn is only supported for: " + ", ".join(sorted(FLASH_ATTN_MODEL_TYPES)))
+    if args.flash_attn:
+        # Checked up front, older transformers would only reveal this after loading every weight
+        flash_model_class = getattr(transformers, MODEL_CLASSES[args.model_type.lower()][0])
+        if transformers_older_than("4.36") or not getattr(flash_model_class, "_supports_flash_attn_2", False):
+            parser.error("--flash_attn: transformers {} cannot load {} with FlashAttention-2".format(
+                transformers.__version__, flash_model_class.__name__))
+    if args.torch_compile and args.ds_inference:
+        parser.error("--torch_compile cannot be combined with --ds-inference")
+    if args.bt and (args.ds_inference or args.flash_attn or args.fp8 or args.int8):
+        parser.error("--bt cannot be combined with --ds-inference, --flash_attn, --fp8 or --int8")
+    if args.pp_size > 1:
+        if args.ds_inference or args.fp8:
+            parser.error("--pp_size cannot be combined with --ds-inference or --fp8")
+        if args.pp_size > torch.cuda.device_count():
+            parser.error("--pp_size {} exceeds the {} visible GPUs".format(args.pp_size, torch.cuda.device_count()))
+    if args.cache_prefix:
+        # Older prepare_inputs_for_generation reads `past` and silently ignores a passed past_key_values
+        if transformers_older_than("4.36"):
+            parser.error("--cache_prefix requires transformers>=4.36, found {}".format(transformers.__version__))
+        if not (args.prefix or args.padding_text):
+            parser.error("--cache_prefix requires --prefix")
+        if args.model_type.lower() in PREPROCESSING_FUNCTIONS or args.ds_inference or args.num_return_sequences > 1:
+            parser.error("--cache_prefix is not supported with --ds-inference, --num_return_sequences > 1 "
+                         "or models that preprocess their prompts")
+    if args.length == 0:
+        parser.error("--length must be non-zero, use a negative value to generate up to the model size")
+    if args.temperature == 0 and args.num_return_sequences > 1:
+        parser.error("--temperature 0 decodes greedily and cannot return more than one sequence")
+    if args.fp8 and (args.fp16 or args.ds_inference):
+        parser.error("--fp8 cannot be combined with --fp16 or --ds-inference")
+    if args.fp8 and args.model_type.lower() not in FP8_MODEL_TYPES:
+        parser.error("--fp8 is only supported for: " + ", ".join(sorted(FP8_MODEL_TYPES)))
+    # DeepSpeed kernel injection cannot replace bitsandbytes Linear8bitLt modules
+    if args.int8 and (args.fp8 or args.ds_inference):
+        parser.error("--int8 cannot be combined with --fp8 or --ds-inference")
+
     args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
     args.n_gpu = 0 if args.no_cuda else torch.cuda.device_count()
 
@@ -241,108 +489,216 @@ def main():
     # Initialize the model and tokenizer
     try:
         args.model_type = args.model_type.lower()
-        model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+        model_class, tokenizer_class = (getattr(transformers, name) for name in MODEL_CLASSES[args.model_type])
     except KeyError:
         raise KeyError("the model {} you specified is not supported. You are welcome to add it and open a PR :)")
 
-    tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
-    model = model_class.from_pretrained(args.model_name_or_path)
-    model.cuda(torch.cuda.current_device())
+    # Load the tokenizer and read the prompt file in the background while the model weights load
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    tokenizer_future = executor.submit(tokenizer_class.from_pretrained, args.model_name_or_path)
+    if args.sample_input:
+        prompt_future = executor.submit(read_prompts, args.sample_input)
+
+    model = load_model(args, model_class)
+    if args.flash_attn:
+        # Backstop for the check above: an unsupported attn_implementation kwarg can end up on the config unused
+        if getattr(model.config, "_attn_implementation", None) != "flash_attention_2":
+            raise ValueError("--flash_attn: this transformers version cannot load {} with FlashAttention-2 "
+                             "(transformers {})".format(args.model_type, transformers.__version__))
+    if args.fp8:
+        # Row-wise scaled torch._scaled_mm is only implemented for sm_90 in torch 2.5
+        assert torch.cuda.get_device_capability() >= (9, 0), "--fp8 requires an sm_90 (Hopper) GPU"
+        # Everything that is not quantized (embeddings, norms, output head, KV cache) stays in bf16
+        model = quantize_fp8(model.to(torch.bfloat16))
+    # from_pretrained has already placed bitsandbytes and pipeline-split models on the GPU(s)
+    if not (args.int8 or args.pp_size > 1):
+        model.cuda(torch.cuda.current_device())
+
+        if args.fp16:
+            model.half()
 
-    if args.fp16:
-        model.half()
+    args.length = adjust_length_to_model(args.length, max_sequence_length=model.config.max_position_embeddings)
 
     # intialize deepspeed engine
     if args.ds_inference:
-        import deepspeed.module_inject as module_inject
         import deepspeed
-        injection_policy={gpt2_transformer:
-                          module_inject.replace_policy.HFGPT2LayerPolicy}
         model = deepspeed.init_inference(model,
                                          mp_size=1,
                                          dtype=(torch.half if args.fp16 else torch.float),
-                                         injection_policy=injection_policy,
+                                         injection_policy=get_injection_policy(),
                                          replace_with_kernel_inject=True)
         model = model.module
+    elif args.bt:
+        from optimum.bettertransformer import BetterTransformer
+        model = BetterTransformer.transform(model, keep_original_model=False)
+        if args.model_type == "gpt2" and model.config.activation_function == "gelu_new":
+            from transformers.models.gpt2.modeling_gpt2 import GPT2MLP
+            GPT2MLP.forward = gpt2_mlp_forward
+    elif args.model_type == "gpt2" and not args.flash_attn:
+        from transformers.models.gpt2.modeling_gpt2 import GPT2Attention
+        # Only transformers versions whose eager GPT-2 attention still goes through _attn
+        if hasattr(GPT2Attention, "_attn"):
+            GPT2Attention._attn = gpt2_attn
+            if not model.config.add_cross_attention:
+                GPT2Attention.forward = gpt2_attn_forward
+
+    if args.torch_compile:
+        # generate() calls self(...), so compiling forward is what puts the decode steps on the compiled path
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
 
-    args.length = adjust_length_to_model(args.length, max_sequence_length=model.config.max_position_embeddings)
     logger.info(args)
+    tokenizer = tokenizer_future.result()
     if args.sample_input:
-        fname = open(args.sample_input, "r", encoding="utf8")
-        prompt_text = fname.readlines()
+        prompt_text = prompt_future.result()
     else:
         prompt_text = (args.prompt if args.prompt else input("Model prompt >>> "),)
+    executor.shutdown()
 
     # Different models need different input formatting and/or extra arguments
     requires_preprocessing = args.model_type in PREPROCESSING_FUNCTIONS.keys()
-    eprompt = []
+    tokenizer_kwargs = {}
+    prefix_length = 0
     if requires_preprocessing:
         prepare_input = PREPROCESSING_FUNCTIONS.get(args.model_type)
-        for input_text in prompt_text:
-            preprocessed_prompt_text.append(prepare_input(args, model, tokenizer, prompt_text))
-
-            if model.__class__.__name__ in ["TransfoXLLMHeadModel"]:
-                tokenizer_kwargs = {"add_space_before_punct_symbol": True}
-            else:
-                tokenizer_kwargs = {}
-            for ppt in preprocessed_prompt_text:
-                eprompt.append(tokenizer.encode(
-                    ppt, add_special_tokens=False, return_tensors="pt", **tokenizer_kwargs
-                ))
+        preprocessed_prompt_text = [prepare_input(args, model, tokenizer, ppt) for ppt in prompt_text]
+
+        if model.__class__.__name__ in ["TransfoXLLMHeadModel"]:
+            tokenizer_kwargs = {"add_space_before_punct_symbol": True}
     else:
         prefix = args.prefix if args.prefix else args.padding_text
-        for ppt in prompt_text:
-            eprompt.append(tokenizer.encode(prefix + ppt, add_special_tokens=False, return_tensors="pt"))
-
-    latencies = []
-    for encoded_prompt, ppt in zip(eprompt, prompt_text):
-        encoded_prompt = encoded_prompt.to(args.device)
-
-        if encoded_prompt.size()[-1] == 0:
-            input_ids = None
+        if args.cache_prefix:
+            # The prefix is tokenized on its own and prepended after padding, see below
+            prefix_ids = tokenizer(prefix, add_special_tokens=False, return_tensors="pt").input_ids
+            prefix_length = prefix_ids.size(-1)
+            preprocessed_prompt_text = list(prompt_text)
+        else:
+            preprocessed_prompt_text = [prefix + ppt for ppt in prompt_text]
+
+    # Left-pad each chunk of batch_size prompts to its own longest prompt, every chunk is one generate call
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        # openai-gpt and ctrl have no eos token, so fall back to unk and only then to a new [PAD] token
+        if tokenizer.eos_token is not None:
+            tokenizer.pad_token = tokenizer.eos_token
+        elif tokenizer.unk_token is not None:
+            tokenizer.pad_token = tokenizer.unk_token
         else:
-            input_ids = encoded_prompt
+            tokenizer.add_special_tokens({"pad_token": "[PAD]"})
+            model.resize_token_embeddings(len(tokenizer))
+    chunks = []
+    for start in range(0, len(prompt_text), args.batch_size):
+        encoded_prompts = tokenizer(
+            preprocessed_prompt_text[start:start + args.batch_size],
+            add_special_tokens=False,
+            padding=True,
+            truncation=True,
+            return_tensors="pt",
+            **tokenizer_kwargs,
+        )
+        if args.torch_compile:
+            # Chunks have different prompt lengths, bucketing them to powers of two bounds the number of
+            # distinct prefill shapes, so later chunks reuse graphs compiled for earlier ones
+            prompt_length = encoded_prompts.input_ids.size(-1)
+            pad = (1 << max(prompt_length - 1, 0).bit_length()) - prompt_length
+            encoded_prompts["input_ids"] = torch.nn.functional.pad(
+                encoded_prompts.input_ids, (pad, 0), value=tokenizer.pad_token_id)
+            encoded_prompts["attention_mask"] = torch.nn.functional.pad(
+                encoded_prompts.attention_mask, (pad, 0), value=0)
+        if prefix_length:
+            # Put the prefix in front of the padding so its KV cache is identical for every row
+            num_prompts = encoded_prompts.input_ids.size(0)
+            encoded_prompts["input_ids"] = torch.cat(
+                [prefix_ids.expand(num_prompts, -1), encoded_prompts.input_ids], dim=-1)
+            encoded_prompts["attention_mask"] = torch.cat(
+                [torch.ones_like(prefix_ids).expand(num_prompts, -1), encoded_prompts.attention_mask], dim=-1)
+        # Pinned, asynchronous H2D copies, the loop below only consumes device tensors
+        for key in encoded_prompts.keys():
+            encoded_prompts[key] = encoded_prompts[key].pin_memory().to(args.device, non_blocking=True)
+
+        # The generation length only depends on the chunk, so it is fixed before the timed loop
+        prompt_length = encoded_prompts.input_ids.size(-1)
+        max_length = args.length + prompt_length
+        # An empty prompt starts from BOS, which takes one of the max_length positions
+        new_tokens = max_length - max(prompt_length, 1)
+        chunks.append((start, encoded_prompts.input_ids, encoded_prompts.attention_mask,
+                       prompt_length, max_length, new_tokens))
+
+    # top_k=1 or temperature=0 is plain argmax decoding, so skip the sampling path altogether. Greedy search
+    # returns a single sequence per prompt, several return sequences keep sampling with top_k=1.
+    do_sample = args.num_return_sequences > 1 or not (args.k == 1 or args.temperature == 0)
+    sampling_kwargs = dict(temperature=args.temperature, top_k=args.k, top_p=args.p) if do_sample else {}
+
+    latencies = np.empty(len(chunks), dtype=np.float64)
+    num_latencies = 0
+    generated_sequences = []
+    prefix_cache = {}
+    # Every iteration ends with a synchronize, so one up front is enough to start each timer on an idle device
+    torch.cuda.synchronize()
+    for start, input_ids, attention_mask, prompt_length, max_length, new_tokens in chunks:
+        if prompt_length == 0:
+            input_ids, attention_mask = None, None
+
+        generate_kwargs = {}
+        if prefix_length:
+            # The prefix is prefilled once per chunk size, outside the timed region
+            if input_ids.size(0) not in prefix_cache:
+                with torch.no_grad():
+                    # Own the tensors: under --torch_compile the forward's outputs live in CUDA graph memory
+                    # that a later replay overwrites
+                    prefix_cache[input_ids.size(0)] = copy.deepcopy(model(
+                        input_ids=input_ids[:, :prefix_length], use_cache=True).past_key_values)
+            # generate() extends the cache in place, so every chunk starts from its own copy
+            generate_kwargs["past_key_values"] = copy.deepcopy(prefix_cache[input_ids.size(0)])
+            # Wait for the prefill and the cache copy so neither leaks into the measured latency
+            torch.cuda.synchronize()
 
-        torch.cuda.synchronize()
         t0 = time.time()
 
         output_sequences = model.generate(
             input_ids=input_ids,
-            max_length=args.length + len(encoded_prompt[0]),
-            temperature=args.temperature,
-            top_k=args.k,
-            top_p=args.p,
+            attention_mask=attention_mask,
+            max_length=max_length,
+            min_length=max_length,
             repetition_penalty=args.repetition_penalty,
-            do_sample=True,
+            do_sample=do_sample,
+            num_beams=1,
             num_return_sequences=args.num_return_sequences,
+            pad_token_id=tokenizer.pad_token_id,
+            **sampling_kwargs,
+            **generate_kwargs,
         )
         torch.cuda.synchronize()
-        latencies.append((time.time()-t0) / output_sequences.numel())
+        # min_length == max_length, so every returned row holds exactly new_tokens generated tokens
+        if new_tokens > 0:
+            latencies[num_latencies] = (time.time()-t0) / new_tokens / output_sequences.size(0)
+            num_latencies += 1
 
         # Remove the batch dimension when returning multiple sequences
         if len(output_sequences.shape) > 2:
             output_sequences.squeeze_()
 
-        generated_sequences = []
-
         for generated_sequence_idx, generated_sequence in enumerate(output_sequences):
-            print("=== GENERATED SEQUENCE {} ===".format(generated_sequence_idx + 1))
+            sequence_idx = start * args.num_return_sequences + generated_sequence_idx
+            print("=== GENERATED SEQUENCE {} ===".format(sequence_idx + 1))
+            ppt = prompt_text[sequence_idx // args.num_return_sequences]
             generated_sequence = generated_sequence.tolist()
 
-            # Decode text
-            text = tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
+            # Decode only the new tokens, the left-padded prompt fills the first columns of every row
+            text = tokenizer.decode(
+                generated_sequence[prompt_length:],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=True,
+            )
 
             # Remove all text after the stop token
             text = text[: text.find(args.stop_token) if args.stop_token else None]
 
-            # Add the prompt at the beginning of the sequence. Remove the excess text that was used for pre-processing
-            total_sequence = (
-                ppt + text[len(tokenizer.decode(encoded_prompt[0], clean_up_tokenization_spaces=True)) :]
-            )
+            # Add the prompt at the beginning of the sequence, without the text used for pre-processing
+            total_sequence = ppt + text
 
             generated_sequences.append(total_sequence)
             print(total_sequence)
-    print_latency(latencies)
+    print_latency(latencies[:num_latencies])
     return generated_sequences
 
 